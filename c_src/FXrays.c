@@ -11,8 +11,25 @@ $Id$
 #include <stdio.h>
 #include <errno.h>
 #include <string.h>
+#include <stdint.h>
+#ifdef _MSC_VER
+#include <intrin.h>
+#endif
 #include "FXrays.h"
 
+// A support fits in one 128 bit SSE register, so when the compiler has
+// been told that SSE4.1 is available (e.g. by -march=native) the filter
+// test can be done with a single PTEST instruction.
+#if defined(__SSE4_1__) || defined(__AVX__)
+#define FXRAYS_SSE4_1
+#include <smmintrin.h>
+#endif
+
+// Otherwise supports are handled as arrays of native machine words, so
+// that 32 bit targets do not pay for emulated 64 bit operations.
+typedef uintptr_t fxword_t;
+#define SUPPORT_WORDS (sizeof(support_t)/sizeof(fxword_t))
+
 
 
 
@@ -34,10 +51,14 @@ static vertex_t *pop_vertex(vertex_stack_t *stack);
 static void      recycle_vertices(vertex_stack_t *stack, reservoir_t *reservoir);
 static vertex_t *unit_vertex(unsigned int index, reservoir_t *reservoir);
 static void      reduce(int dimension, vertex_t *v);
+static int       gcd(int x, int y);
 
 //supports
 static void support_union(support_t *x, support_t *y, support_t *result);
+static void gather_supports(vertex_stack_t stack, int count,
+			    vertex_t ***vertices, support_t **supports);
 static void set_support(unsigned int index, support_t *support);
+static int  support_size(support_t *support);
 
 //components of the algorithm
 static void evaluate(matrix_t *A, int row, vertex_t *v); 
@@ -47,7 +68,9 @@ static int  test_corank_mod_p(matrix_t *A, int threshold);
 
 // core functions, formerly in mmx.c
 static int  extract_matrix(matrix_t *in, int rows, support_t *support, matrix_t *out);
-static int  filter(vertex_t *v, filter_list_t *filter_list);
+static int  filter(support_t *support, filter_list_t *filter_list);
+static void restrict_filter_list(filter_list_t *in, support_t *support,
+				 filter_list_t *out);
 static int  ax_plus_by(int size, int a, int b, int *x, int *y);
 static void ax_plus_by_mod_p(int size, int a, int b, int *x, int *y);
 static int  dot(int size, int *x, int *y, int *dotprod);
@@ -158,6 +181,32 @@ static void set_support(unsigned int index, support_t *support){
   support->supp[i] |= (1 << (0x1f & (index >> 1)) );
 }
 
+// Returns the number of columns in a support.  This uses the POPCNT
+// instruction when the compiler knows that it is available (e.g. with
+// -march=native).  Otherwise the bits are counted in parallel within
+// each word, since without POPCNT gcc turns __builtin_popcount into a
+// library call, and Microsoft's __popcnt emits POPCNT regardless.
+
+static int support_size(support_t *support){
+  int i, result = 0;
+  unsigned int x;
+
+  for (i = 0; i < 4; i++) {
+    x = support->supp[i];
+#if defined(__GNUC__) && defined(__POPCNT__)
+    result += __builtin_popcount(x);
+#elif defined(_MSC_VER) && defined(__AVX2__)
+    result += __popcnt(x);
+#else
+    x = x - ((x >> 1) & 0x55555555);
+    x = (x & 0x33333333) + ((x >> 2) & 0x33333333);
+    x = (x + (x >> 4)) & 0x0f0f0f0f;
+    result += (x * 0x01010101) >> 24;
+#endif
+  }
+  return result;
+}
+
 static vertex_t *unit_vertex(unsigned int index, reservoir_t *reservoir){
   vertex_t *result;
 
@@ -168,11 +217,7 @@ static vertex_t *unit_vertex(unsigned int index, reservoir_t *reservoir){
   return result;
 }
 
-#ifdef GCC
-inline int gcd(int x, int y){
-#else
-__inline int gcd(int x, int y){
-#endif
+static int gcd(int x, int y){
   int r;
   if (x == 0)
     return y;
@@ -220,6 +265,27 @@ static void support_union(support_t *x, support_t *y, support_t *result){
   }
 }
 
+// Copies the vertices of a stack, and their supports, into arrays.
+// The pairing loop in FXrays_find_vertices scans the negative vertices
+// once for every positive vertex.  Reading their supports from an array
+// touches one cache line per four vertices, instead of one cache line
+// per vertex when following the next pointers through the reservoir.
+
+static void gather_supports(vertex_stack_t stack, int count,
+			    vertex_t ***vertices, support_t **supports){
+  int i;
+  vertex_t *V;
+
+  *vertices = realloc(*vertices, (count + 1)*sizeof(vertex_t *));
+  *supports = realloc(*supports, (count + 1)*sizeof(support_t));
+  if (*vertices == NULL || *supports == NULL)
+    no_memory();
+  for (i = 0, V = stack; V != NULL; i++, V = V->next) {
+    (*vertices)[i] = V;
+    (*supports)[i] = V->support;
+  }
+}
+
 static matrix_t *new_matrix(int rows, int columns){
   matrix_t *result;
 
@@ -266,8 +332,10 @@ static int test_corank(matrix_t *M, int threshold){
     // if there are none, increase the corank and continue
     if (k == numrows) {
       ++corank;
-      if (corank > threshold)
+      if (corank > threshold){
+	free(A);
 	return -1;
+      }
     }
 
     else{
@@ -374,14 +442,8 @@ static int test_corank_mod_p(matrix_t *M, int threshold){
   return corank;
 }
 
-filter_list_t *FXrays_embedded_filter(int tets){
+static filter_list_t *new_filter_list(int size){
   filter_list_t *result;
-  int i,size = 3*tets;
-
-  if (tets > 42){
-      fprintf(stderr, "Too many tetrahedra!\n");
-    exit(-1);
-  }
 
   // NOTE: this assumes that calloc will give us 8-byte aligned memory.
   // gcc says it will do that.
@@ -391,6 +453,19 @@ filter_list_t *FXrays_embedded_filter(int tets){
   if (result == NULL) no_memory();
 
   result->size = size;
+  return result;
+}
+
+filter_list_t *FXrays_embedded_filter(int tets){
+  filter_list_t *result;
+  int i,size = 3*tets;
+
+  if (tets > 42){
+      fprintf(stderr, "Too many tetrahedra!\n");
+    exit(-1);
+  }
+
+  result = new_filter_list(size);
 
   for (i=0; i<size; i+=3) {
     set_support(i,   result->filter + i);
@@ -408,38 +483,87 @@ void FXrays_destroy_filter_list(filter_list_t *filterlist){
     free(filterlist);
 };
 
+// Copies into out those filters which meet the given support.  The
+// output list must have room for all of the filters in the input list.
+//
+// If P and N are vertices with legal supports then the support of any
+// filter contained in the union of their supports must meet the
+// support of P, since it is not contained in the support of N.  So,
+// when pairing P with each of the negative vertices, it suffices to
+// test against the filters which meet P.  For the embedded filter this
+// is usually a small fraction of the list.
+//
+// NOTE: this requires every vertex to have legal support.  Vertices
+// made by pairing are filtered, but the initial unit vertices are not,
+// so the filter list must not contain any single column supports.
+// This holds for FXrays_embedded_filter, whose filters are pairs of
+// columns, but a filter list built by hand must satisfy it too.
+
+static void restrict_filter_list(filter_list_t *in, support_t *support,
+				 filter_list_t *out){
+  int i, count = 0;
+  support_t *filter = in->filter;
+
+  for (i = 0; i < in->size; i++, filter++) {
+    if ((filter->supp[0] & support->supp[0]) |
+	(filter->supp[1] & support->supp[1]) |
+	(filter->supp[2] & support->supp[2]) |
+	(filter->supp[3] & support->supp[3]))
+      out->filter[count++] = *filter;
+  }
+  out->size = count;
+}
+
 // A vector passes a filter test if its support does not contain the
-// support of a filter.  This function returns a non-zero value if
-// the vertex vector passes all the filter tests, or returns 0 as soon as
-// any test fails.  The non-zero value is not meaningful, being just
-// the support of the last filter intersected with the complement of
-// the support of the vector.
+// support of a filter.  This function returns 1 if the given support
+// passes all the filter tests, or returns 0 as soon as any test fails.
+//
+// With SSE4.1 each filter test is a single PTEST of the whole 128 bit
+// support.  Otherwise the supports are handled as machine words, so on
+// a 64 bit target each filter test costs two ANDs and an OR.  Since
+// supports are declared as arrays of unsigned ints, the words are
+// loaded with memcpy, which the compiler turns into plain loads.
 
-static int filter(vertex_t *v, filter_list_t *filter_list){
+static int filter(support_t *support, filter_list_t *filter_list){
   int size;
   support_t *filter;
-  register int CS0, CS1, CS2, CS3, result=0;
+#ifdef FXRAYS_SSE4_1
+  __m128i S, F;
+#else
+  fxword_t CS[SUPPORT_WORDS], F[SUPPORT_WORDS], result;
+  unsigned int i;
+#endif
 
   if (filter_list == NULL)
     return 1;
   size = filter_list->size;
   filter = filter_list->filter;
 
-  CS0=~(v->support.supp[0]);
-  CS1=~(v->support.supp[1]); 
-  CS2=~(v->support.supp[2]);
-  CS3=~(v->support.supp[3]);
+#ifdef FXRAYS_SSE4_1
+  S = _mm_loadu_si128((__m128i *)support->supp);
+  while (size--) {
+    F = _mm_loadu_si128((__m128i *)filter->supp);
+    // PTEST sets the carry flag iff F & ~S == 0.
+    if (_mm_testc_si128(S, F))
+      return 0;
+    ++filter;
+  }
+#else
+  memcpy(CS, support->supp, sizeof(support_t));
+  for (i = 0; i < SUPPORT_WORDS; i++)
+    CS[i] = ~CS[i];
 
   while (size--) {
+    memcpy(F, filter->supp, sizeof(support_t));
     result = 0;
-    result |= (filter->supp[0] & CS0); 
-    result |= (filter->supp[1] & CS1); 
-    result |= (filter->supp[2] & CS2); 
-    result |= (filter->supp[3] & CS3);
-    if (result == 0) break;
+    for (i = 0; i < SUPPORT_WORDS; i++)
+      result |= F[i] & CS[i];
+    if (result == 0)
+      return 0;
     ++filter;
   }
-  return result;
+#endif
+  return 1;
 }
 
 void *FXrays_find_vertices(matrix_t *matrix, filter_list_t *filter_list, int print_progress,
@@ -450,9 +574,15 @@ void *FXrays_find_vertices(matrix_t *matrix, filter_list_t *filter_list, int pri
   int numpos, numneg, numzero;
   vertex_stack_t positives = NULL, negatives = NULL, zeros = NULL, current = NULL;
   reservoir_t *reservoir = new_reservoir(dimension);
-  vertex_t *vertex = NULL, *P, *N;
+  vertex_t *vertex = NULL, *P, *N, **negative_vertices = NULL;
+  support_t *negative_supports = NULL, support;
+  filter_list_t *P_filter_list = NULL;
+  int j;
   matrix_t *temp_matrix = new_matrix(matrix->rows, matrix->columns);
 
+  if (filter_list != NULL)
+    P_filter_list = new_filter_list(filter_list->size);
+
   for (i = 0; i < dimension; i++) {
     push_vertex( unit_vertex(i, reservoir), &current);
   }
@@ -483,22 +613,26 @@ void *FXrays_find_vertices(matrix_t *matrix, filter_list_t *filter_list, int pri
 	printf(" %5d positive %5d negative %5d zero\n",numpos, numneg, numzero);
     }
 
+    gather_supports(negatives, numneg, &negative_vertices, &negative_supports);
     for (P = positives; P != NULL; P = P->next) {
-      for (N = negatives; N != NULL; N = N->next) {
-	if (vertex == NULL)
-	  vertex = new_vertex(reservoir);
-
-	support_union(&P->support, &N->support, &vertex->support);
-
-	if (filter(vertex, filter_list) != 0) {
-	  if (extract_matrix(matrix, slice+1, &vertex->support, temp_matrix) == 1
+      if (filter_list != NULL)
+	restrict_filter_list(filter_list, &P->support, P_filter_list);
+      for (j = 0; j < numneg; j++) {
+	// The support of the candidate is built on the stack, and a new
+	// vertex is only taken from the reservoir if it passes both tests.
+	support_union(&P->support, negative_supports + j, &support);
+
+	if (filter(&support, P_filter_list) != 0) {
+	  if (extract_matrix(matrix, slice+1, &support, temp_matrix) == 1
               && test_corank(temp_matrix, 1) == 1){
+	    vertex = new_vertex(reservoir);
+	    vertex->support = support;
+	    N = negative_vertices[j];
 	    for ( i=0; i<dimension; i++ )
 	      vertex->vector[i] = N->vector[i];
 	    ax_plus_by(dimension, -(N->value), P->value, P->vector, vertex->vector);
 	    reduce(dimension, vertex);
 	    push_vertex(vertex, &zeros);
-	    vertex = NULL;
 	  }
 	  else ++interior;
 	}
@@ -521,6 +655,9 @@ void *FXrays_find_vertices(matrix_t *matrix, filter_list_t *filter_list, int pri
   destroy_reservoir(reservoir);
   reservoir = NULL;
   destroy_matrix(temp_matrix);
+  free(negative_vertices);
+  free(negative_supports);
+  FXrays_destroy_filter_list(P_filter_list);
   return result;
 }
 
@@ -532,7 +669,10 @@ void *FXrays_find_vertices_mod_p(matrix_t *matrix, filter_list_t *filter_list, i
   int numpos, numneg, numzero;
   vertex_stack_t positives = NULL, negatives = NULL, zeros = NULL, current = NULL;
   reservoir_t *reservoir = new_reservoir(dimension);
-  vertex_t *vertex = NULL, *P, *N;
+  vertex_t *vertex = NULL, *P, *N, **negative_vertices = NULL;
+  support_t *negative_supports = NULL, support;
+  filter_list_t *P_filter_list = NULL;
+  int j;
   matrix_t *temp_matrix = new_matrix(matrix->rows, matrix->columns);
   matrix_t *mod_p_matrix = new_matrix(matrix->rows, matrix->columns);
 
@@ -543,6 +683,9 @@ void *FXrays_find_vertices_mod_p(matrix_t *matrix, filter_list_t *filter_list, i
     mod_p_matrix->matrix[i] = x;
   }
 
+  if (filter_list != NULL)
+    P_filter_list = new_filter_list(filter_list->size);
+
   for (i = 0; i < dimension; i++) {
     push_vertex( unit_vertex(i, reservoir), &current);
   }
@@ -574,22 +717,26 @@ void *FXrays_find_vertices_mod_p(matrix_t *matrix, filter_list_t *filter_list, i
 	printf(" %5d positive %5d negative %5d zero\n",numpos, numneg, numzero);
     }
 
+    gather_supports(negatives, numneg, &negative_vertices, &negative_supports);
     for (P = positives; P != NULL; P = P->next) {
-      for (N = negatives; N != NULL; N = N->next) {
-	if (vertex == NULL)
-	  vertex = new_vertex(reservoir);
-
-	support_union(&P->support, &N->support, &vertex->support);
-
-	if (filter(vertex, filter_list) != 0) {
-        if (extract_matrix(mod_p_matrix, slice+1, &vertex->support, temp_matrix) == 1
+      if (filter_list != NULL)
+	restrict_filter_list(filter_list, &P->support, P_filter_list);
+      for (j = 0; j < numneg; j++) {
+	// The support of the candidate is built on the stack, and a new
+	// vertex is only taken from the reservoir if it passes both tests.
+	support_union(&P->support, negative_supports + j, &support);
+
+	if (filter(&support, P_filter_list) != 0) {
+        if (extract_matrix(mod_p_matrix, slice+1, &support, temp_matrix) == 1
 	    && test_corank_mod_p(temp_matrix, 1) == 1){
+	    vertex = new_vertex(reservoir);
+	    vertex->support = support;
+	    N = negative_vertices[j];
 	    for ( i=0; i<dimension; i++ )
 	      vertex->vector[i] = N->vector[i];
 	    ax_plus_by(dimension, -(N->value), P->value, P->vector, vertex->vector);
 	    reduce(dimension, vertex);
 	    push_vertex(vertex, &zeros);
-	    vertex = NULL;
 	  }
 	  else ++interior;
 	}
@@ -612,6 +759,9 @@ void *FXrays_find_vertices_mod_p(matrix_t *matrix, filter_list_t *filter_list, i
   destroy_reservoir(reservoir);
   reservoir = NULL;
   destroy_matrix(temp_matrix);
+  free(negative_vertices);
+  free(negative_supports);
+  FXrays_destroy_filter_list(P_filter_list);
   destroy_matrix(mod_p_matrix);
   return result;
 }
@@ -672,26 +822,38 @@ static int ax_plus_by(int size, int a, int b, int *x, int *y){
   return result;
 }
 
-// This returns a non-zero value if any partial sum of the dot product
-// overflows a 32 bit integer.
+// This returns a non-zero value if the dot product overflows a 32 bit
+// integer.  The products are computed as 64 bit numbers, so a partial
+// sum which overflows 32 bits is harmless and the sum itself only needs
+// to be checked at the end.  However, the 64 bit sum could wrap if the
+// products were huge.  So we also record whether any product is 2^55 or
+// more in absolute value; if none is, then the sum of at most 128
+// products (the most that a support allows) is less than 2^62, and
+// cannot wrap.  The sum is accumulated as an unsigned number, so that
+// wrapping is well defined even when it does happen.  Keeping the
+// checks branch free lets the compiler vectorize the loop.
 
 static int dot(int size, int *x, int *y, int *dotprod){
-  register int result = 0;
-  register int *X = x, *Y = y;
-  register long long accumulator = 0;
-  while (size--){
-    accumulator += ((long long)*X++)*((long long)*Y++);
-    result |= (((accumulator >> 32) + 1) >> 1);
+  register unsigned long long accumulator = 0;
+  register long long prod, big = 0, sum;
+  int i;
+
+  for (i = 0; i < size; i++) {
+    prod = ((long long)x[i])*((long long)y[i]);
+    accumulator += (unsigned long long)prod;
+    big |= (prod ^ (prod >> 63)) >> 55;
   }
   *dotprod = accumulator & 0xffffffff;
-  return result;
+  if (big != 0)
+    return 1;
+  sum = (long long)accumulator;
+  return (((sum >> 32) + 1) >> 1) != 0;
 }
 
 // This extracts those columns of the input matrix specified by the
 // support vector.  If dimension considerations show that the the
 // resulting matrix could not possibly have co-rank 1, the extraction
-// is aborted and 0 is returned (leaving garbage in the output
-// matrix). Otherwise the return value is 1.
+// is skipped and 0 is returned. Otherwise the return value is 1.
 //
 // WARNING: This may write one int past the end of the array.  Allow
 // extra space in your output matrix!!!
@@ -703,8 +865,15 @@ static int extract_matrix(matrix_t *in, int rows, support_t *support, matrix_t *
   register int *in_coeff = in->matrix;
   register int *out_coeff = out->matrix;
   register int supp1, supp2, temp;
-  int count1, count2, count, columns_out = 0;
-  
+  int count1, count2, count, columns_out;
+
+  // Bail out if there aren't enough rows for the co-rank to be 1.
+  columns_out = support_size(support);
+  if (rows < columns_out - 1)
+    return 0;
+  out->rows = rows;
+  out->columns = columns_out;
+
   if (in->columns > 64){
     count1 = 64;
     count2 = in->columns - 64;
@@ -714,36 +883,7 @@ static int extract_matrix(matrix_t *in, int rows, support_t *support, matrix_t *
     count2 = 0;
   }
 
-  out->rows = rows;
-  // We have to look at the first row to count how many columns the
-  // output matrix will have.
-  supp1 = support->supp[0];
-  supp2 = support->supp[2];
-  count = count1;
-  while (count--){
-    *out_coeff = *in_coeff++;
-    out_coeff += (supp1 & 0x1);
-    temp = supp1 >> 1;
-    supp1 = supp2;
-    supp2 = temp;
-  }
-  supp1 = support->supp[1];
-  supp2 = support->supp[3];
-  count = count2;
-  while (count--){
-    *out_coeff = *in_coeff++;
-    out_coeff += (supp1 & 0x1);
-    temp = supp1 >> 1;
-    supp1 = supp2;
-    supp2 = temp;
-  }
-  columns_out = (int)(out_coeff - out->matrix);
-  // Bail out if there aren't enough rows for the co-rank to be 1.
-  if (rows < columns_out - 1)
-    return 0;
-  out->columns = (int)columns_out;
-  // Otherwise extract the rest of the rows.
-  while (--rows) {
+  while (rows--) {
     supp1 = support->supp[0];
     supp2 = support->supp[2];
     count = count1;
@@ -70,6 +70,8 @@ void           FXrays_destroy_filter_list(filter_list_t *filterlist);
 
 
 //main functions
+// NOTE: the filters in filter_list must each contain at least two
+// columns, as those made by FXrays_embedded_filter do.
 void *FXrays_find_vertices(matrix_t *matrix, filter_list_t *filter_list, int print_progress, 
 		    void *(*output_func)(vertex_stack_t *stack, int dimension));
 void *FXrays_find_vertices_mod_p(matrix_t *matrix, filter_list_t *filter_list, int print_progress, 
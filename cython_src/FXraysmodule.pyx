@@ -1,4 +1,6 @@
-#cython: language_level=3
+#cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+
+from libc.string cimport memcpy
 
 cdef extern from "FXrays.h":
     cdef struct support_s:
@@ -40,8 +42,9 @@ cdef extern from "FXrays.h":
 cdef extern from "Python.h":
     cdef void Py_INCREF(object o)
 
-cdef void* build_vertex_list(vertex_stack_t *stack, int dimension):
+cdef void* build_vertex_list(vertex_stack_t *stack, int dimension) noexcept:
     cdef long coeff
+    cdef int i
     cdef vertex_t *V = stack[0]
     result = []
     while V != NULL:
@@ -69,7 +72,9 @@ def find_Xrays(int rows, int columns, matrix, modp=False,
     columns: Number of columns of the matrix of linear equations.
 
     matrix: The matrix of linear equations, given as a flat list of length
-    rows*columns.
+    rows*columns.  If it is a contiguous buffer of C ints, such as an
+    array.array('i'), it is copied directly rather than converting each
+    entry.
 
     modp (optional, default False): Whether to do the computation
     over p = 2^31 - 1 rather than Z.
@@ -84,6 +89,8 @@ def find_Xrays(int rows, int columns, matrix, modp=False,
     """
     cdef filter_list_t *filter = NULL
     cdef matrix_t *c_matrix = FXrays_new_matrix(rows, columns)
+    cdef int i
+    cdef const int[::1] buffer
 
     if rows < 0 or columns < 0 or len(matrix) != rows*columns:
         raise ValueError('rows*columns != length of matrix list.')
@@ -91,8 +98,14 @@ def find_Xrays(int rows, int columns, matrix, modp=False,
     if filtering:
         filter = FXrays_embedded_filter(columns//3)
 
-    for i, c in enumerate(matrix):
-        c_matrix.matrix[i] = c
+    try:
+        buffer = matrix
+    except (TypeError, ValueError, BufferError):
+        for i, c in enumerate(matrix):
+            c_matrix.matrix[i] = c
+    else:
+        if rows*columns > 0:
+            memcpy(c_matrix.matrix, &buffer[0], rows*columns*sizeof(int))
 
     if modp:
         result = <object> FXrays_find_vertices_mod_p(c_matrix, filter,
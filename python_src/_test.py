@@ -1,3 +1,4 @@
+from array import array
 from .FXraysmodule import find_Xrays
 
 def test0():
@@ -211,3 +212,47 @@ def t12345_matrix():
                0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, -1, 0, 1, -1, 0, 1, -1, -2, 0, 2]
 
     return rows, columns, matrix
+
+def buffer_matrix():
+    """
+    >>> rows, cols, matrix = t12345_matrix()
+    >>> buffer = array('i', matrix)
+    >>> (find_Xrays(rows, cols, buffer, print_progress=False) ==
+    ...  find_Xrays(rows, cols, matrix, print_progress=False))
+    True
+    >>> strided = memoryview(array('i', [x for x in matrix for y in (0, 1)]))[::2]
+    >>> (find_Xrays(rows, cols, strided, print_progress=False) ==
+    ...  find_Xrays(rows, cols, matrix, print_progress=False))
+    True
+    """
+
+def wide_matrix():
+    """
+    Three copies of t12345_matrix placed block diagonally, giving 72
+    columns, so that supports include columns past 64.  The extremal
+    rays are those of the blocks, padded with zeros.
+
+    >>> rows, cols, matrix = wide_matrix()
+    >>> rows, cols
+    (24, 72)
+    >>> block_rows, block_cols, block = t12345_matrix()
+    >>> for modp in (False, True):
+    ...     rays = find_Xrays(block_rows, block_cols, block, modp=modp,
+    ...                       print_progress=False)
+    ...     expected = sorted((0,)*(block_cols*k) + ray + (0,)*(block_cols*(2 - k))
+    ...                       for k in range(3) for ray in rays)
+    ...     wide = find_Xrays(rows, cols, matrix, modp=modp,
+    ...                       print_progress=False)
+    ...     print(len(wide), sorted(wide) == expected)
+    123 True
+    123 True
+    """
+    block_rows, block_cols, block = t12345_matrix()
+    rows, columns = 3*block_rows, 3*block_cols
+    matrix = [0]*(rows*columns)
+    for k in range(3):
+        for i in range(block_rows):
+            for j in range(block_cols):
+                matrix[(k*block_rows + i)*columns + k*block_cols + j] = (
+                    block[i*block_cols + j])
+    return rows, columns, matrix
@@ -0,0 +1,53 @@
+"""
+Times find_Xrays on the matrices from the test suite.  This is also
+the workload used to collect the profile for a profile guided build:
+
+    python -m FXrays.bench
+
+NOTE: the whole workload runs in about 0.1 seconds, and these matrices
+are much smaller than the ones FXrays is meant for.  The resulting
+profile is not representative, so builds made with "setup.py pgo" or
+"setup.py release --pgo" should be regarded as provisional until real
+triangulation matrices are added to problems().
+"""
+
+import time
+from . import _test
+from .FXraysmodule import find_Xrays
+
+def problems():
+    rows, columns, matrix = _test.t12345_matrix()
+    return [
+        ('test0', _test.test0),
+        ('test1', _test.test1),
+        ('test2', _test.test2),
+        ('magic5', _test.magic5),
+        ('t12345', lambda : find_Xrays(rows, columns, matrix,
+                                       print_progress=False)),
+        ('t12345 modp', lambda : find_Xrays(rows, columns, matrix, modp=True,
+                                            print_progress=False)),
+        ('t12345 unfiltered', lambda : find_Xrays(rows, columns, matrix,
+                                                  filtering=False,
+                                                  print_progress=False)),
+    ]
+
+def run(repeat=3):
+    """
+    Returns a list of pairs (name, seconds) giving the best of repeat
+    runs for each problem.
+    """
+    results = []
+    for name, problem in problems():
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            problem()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append((name, best))
+    return results
+
+if __name__ == '__main__':
+    for name, seconds in run():
+        print('%-20s %8.4f' % (name, seconds))
@@ -20,9 +20,13 @@ The algorithm is due to Dave Letscher, and incorporates ideas of Komei
 Fukuda's.
 """
 
-import os, re, sys, sysconfig, shutil, subprocess, site
+import os, re, sys, shutil, subprocess, site
 from setuptools import setup, Command, Extension
+from setuptools.command.build_ext import build_ext
+from setuptools.command.sdist import sdist
 from distutils.util import get_platform
+from distutils.ccompiler import new_compiler
+from distutils.sysconfig import customize_compiler
 from glob import glob
 
 
@@ -30,41 +34,97 @@ from glob import glob
 version = re.search("__version__ = '(.*)'",
                     open('python_src/__init__.py').read()).group(1)
 
-extra_link_args = []
-extra_compile_args = []
-if sys.platform.startswith('win'):
-    # NOTE: this is for msvc not mingw32
-    # There are issues with mingw64 linking agains msvcrt.
-    extra_compile_args = ['/Ox']
-else:
-    extra_compile_args=['-O3', '-funroll-loops']
-
-if sys.platform.startswith('linux'):
-    extra_link_args=['-Wl,-Bsymbolic-functions', '-Wl,-Bsymbolic']
-else:
-    extra_link_args=[]
-
 FXrays = Extension(
     name = 'FXrays.FXraysmodule',
     sources = ['cython_src/FXraysmodule.c', 'c_src/FXrays.c'],
     include_dirs = ['cython_src', 'c_src'], 
-    extra_compile_args = extra_compile_args,
-    extra_link_args = extra_link_args
 )
 
+cython_sources = ['cython_src/FXraysmodule.pyx']
+
+def cythonize_sources(required=False):
+    try:
+        from Cython.Build import cythonize
+    except ImportError:
+        missing = [file for file in cython_sources
+                   if not os.path.exists(file[:-4] + '.c')]
+        if required and missing:
+            raise RuntimeError('Cython is needed to generate the C files.')
+        return
+    files = [file for file in cython_sources if os.path.exists(file)]
+    if files:
+        cythonize(files, nthreads=os.cpu_count())
+
+class FXraysBuildExt(build_ext):
+    """
+    Choose the optimization flags according to the compiler which is
+    actually used, rather than guessing it from the platform.  Also,
+    if we have Cython, check that the .c files are up to date before
+    building.  This is done here, rather than when setup.py is loaded,
+    so that commands such as clean do not run Cython.
+    """
+    def run(self):
+        cythonize_sources()
+        build_ext.run(self)
+
+    def build_extensions(self):
+        compiler = self.compiler.compiler_type
+        # Setting FXRAYS_NATIVE=1 tunes the build for the CPU of the build
+        # machine, allowing the compiler to use AVX2, POPCNT, etc.  The
+        # resulting extension will not run on older CPUs, so this must not
+        # be used when building wheels for distribution.
+        native = os.environ.get('FXRAYS_NATIVE', '0') not in ('', '0')
+        if compiler == 'msvc':
+            extra_compile_args = ['/Ox', '/GL']
+            extra_link_args = ['/LTCG']
+            if native:
+                extra_compile_args += ['/arch:AVX2']
+        else:
+            extra_compile_args = ['-O3', '-funroll-loops']
+            extra_link_args = []
+            # LTO has only been tested with the unix compilers.
+            if compiler == 'unix':
+                extra_compile_args += ['-flto']
+                extra_link_args += ['-flto']
+            if native:
+                extra_compile_args += ['-march=native']
+            if sys.platform.startswith('linux'):
+                extra_compile_args += ['-fno-semantic-interposition']
+                extra_link_args += ['-Wl,-Bsymbolic-functions', '-Wl,-Bsymbolic']
+        for ext in self.extensions:
+            ext.extra_compile_args = extra_compile_args + ext.extra_compile_args
+            ext.extra_link_args = extra_link_args + ext.extra_link_args
+        build_ext.build_extensions(self)
+
+class FXraysSdist(sdist):
+    """
+    Generate the .c files before making the archive, so that the sdist
+    can be installed without Cython.  If Cython is not available, the
+    existing .c files are packaged, provided none of them are missing.
+    """
+    def run(self):
+        cythonize_sources(required=True)
+        sdist.run(self)
+
 class FXraysClean(Command):
     """
     Clean *all* the things!
     """
-    user_options = []
+    user_options = [('fast-clean', 'f',
+                     'keep generated C files which are newer than their .pyx')]
     def initialize_options(self):
-        pass 
+        self.fast_clean = False
     def finalize_options(self):
         pass
     def run(self):
         for dir in ['build', 'dist', 'FXrays.egg-info']:
             shutil.rmtree(dir, ignore_errors=True)
         for file in glob('*.pyc') + glob('cython_src/*.c'):
+            if self.fast_clean and file.endswith('.c'):
+                pyx = file[:-2] + '.pyx'
+                if (os.path.exists(pyx) and
+                    os.path.getmtime(pyx) < os.path.getmtime(file)):
+                    continue
             if os.path.exists(file):
                 os.remove(file)
 
@@ -75,12 +135,7 @@ class FXraysTest(Command):
     def finalize_options(self):
         pass
     def run(self):
-        build_lib_dir = os.path.join(
-            'build',
-            'lib.{platform}-{version_info[0]}.{version_info[1]}'.format(
-                platform=sysconfig.get_platform(),
-                version_info=sys.version_info)
-        )
+        build_lib_dir = self.get_finalized_command('build').build_lib
         sys.path.insert(0, os.path.abspath(build_lib_dir))
         from FXrays.test import runtests
         results = runtests()
@@ -88,21 +143,84 @@ class FXraysTest(Command):
         status = 0 if results.failed == 0 else 1
         sys.exit(status)
 
-def check_call(args):
+def check_call(args, env=None):
     try:
-        subprocess.check_call(args)
+        subprocess.check_call(args, env=env)
     except subprocess.CalledProcessError:
         executable = args[0]
         command = [a for a in args if not a.startswith('-')][-1]
         raise RuntimeError(command + ' failed for ' + executable)
         
+class FXraysPGO(Command):
+    """
+    Build the extension with profile guided optimization.  An
+    instrumented build is made first and FXrays.bench is run to collect
+    a profile, which is then used for the final build.  Requires gcc:
+    clang needs its raw profiles merged with llvm-profdata before they
+    can be used, and msvc ignores CFLAGS.  The training workload is
+    still small (see FXrays/bench.py), so treat the result as
+    provisional.
+    """
+    user_options = []
+    def initialize_options(self):
+        pass
+    def finalize_options(self):
+        pass
+    def check_compiler(self):
+        compiler = new_compiler()
+        customize_compiler(compiler)
+        if compiler.compiler_type == 'unix':
+            try:
+                version = subprocess.check_output(
+                    compiler.compiler_so[:1] + ['--version'],
+                    universal_newlines=True)
+            except (OSError, subprocess.CalledProcessError):
+                version = 'unknown'
+            if 'free software foundation' in version.lower():
+                return
+        raise RuntimeError('The pgo command requires gcc.')
+    def run(self):
+        self.check_compiler()
+        python = sys.executable
+        profile_dir = os.path.abspath(os.path.join('build', 'pgo'))
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        cflags = os.environ.get('CFLAGS', '')
+        env = dict(os.environ)
+        env['CFLAGS'] = cflags + ' -fprofile-generate=' + profile_dir
+        check_call([python, 'setup.py', 'build', '--force'], env=env)
+        bench_env = dict(os.environ)
+        bench_env['PYTHONPATH'] = os.path.abspath(
+            self.get_finalized_command('build').build_lib)
+        check_call([python, '-m', 'FXrays.bench'], env=bench_env)
+        env['CFLAGS'] = (cflags + ' -fprofile-use=' + profile_dir +
+                         ' -fprofile-correction')
+        check_call([python, 'setup.py', 'build', '--force'], env=env)
+
 class FXraysRelease(Command):
-    user_options = [('install', 'i', 'install the release into each Python')]
+    user_options = [('install', 'i', 'install the release into each Python'),
+                    ('pgo', 'p', 'use profile guided optimization')]
     def initialize_options(self):
         self.install = False
+        self.pgo = False
     def finalize_options(self):
         pass
+    def check_build_flags(self):
+        """
+        Do a dry run of build_ext and make sure that it really applied
+        the optimization flags, since the extension still builds and
+        passes its tests without them.
+        """
+        cmd = self.reinitialize_command('build_ext')
+        cmd.dry_run = True
+        cmd.force = True
+        self.run_command('build_ext')
+        for ext in self.distribution.ext_modules:
+            flags = set(ext.extra_compile_args)
+            if not flags & {'-O3', '/Ox'}:
+                raise RuntimeError('build_ext did not set the flags for ' +
+                                   ext.name)
     def run(self):
+        self.check_build_flags()
         if os.path.exists('build'):
             shutil.rmtree('build')
         if os.path.exists('dist'):
@@ -110,6 +228,8 @@ class FXraysRelease(Command):
 
         pythons = os.environ.get('RELEASE_PYTHONS', sys.executable).split(',')
         for python in pythons:
+            if self.pgo:
+                check_call([python, 'setup.py', 'pgo'])
             check_call([python, 'setup.py', 'build'])
             check_call([python, 'setup.py', 'test'])
             if self.install:
@@ -146,16 +266,6 @@ class FXraysPipInstall(Command):
         
                    
 
-# If have Cython, check that .c files are up to date:
-
-try:
-    from Cython.Build import cythonize
-    if 'clean' not in sys.argv:
-        file = 'cython_src/FXraysmodule.pyx'
-        if os.path.exists(file):
-            cythonize([file])
-except ImportError:
-    pass 
 
 
 setup(
@@ -175,15 +285,21 @@ setup(
         'Programming Language :: C',
         'Programming Language :: Cython',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
+        'Programming Language :: Python :: 3.13',
         'Topic :: Scientific/Engineering :: Mathematics',
         ],
 
     packages = ['FXrays'],
     package_dir = {'FXrays':'python_src'}, 
     ext_modules = [FXrays],
-    cmdclass = {'clean':FXraysClean,
+    cmdclass = {'build_ext':FXraysBuildExt,
+                'sdist':FXraysSdist,
+                'clean':FXraysClean,
                 'test':FXraysTest,
                 'release':FXraysRelease,
+                'pgo':FXraysPGO,
                 'pip_install':FXraysPipInstall,
     },
     zip_safe=False, 